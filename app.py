@@ -15,7 +15,7 @@ from kivy.graphics import Ellipse, Color, Line
 from kivy.graphics.instructions import InstructionGroup
 
 import numpy as np
-from math import atan2, sin, cos
+from numba import njit, prange
 
 # Define size and center coordinate of world
 WORLD_WIDTH = 5e8     # world length (in km) visible in window's width
@@ -47,57 +47,79 @@ SPEED_VENUS = 35.02
 GRAVITY_CONST = 6.6743e-20
 
 # each simulation step advances time by this many seconds
-DELTA_T = 100
+DELTA_T = 1000
 
 # run this many simulation steps for each graphical update
-STEPS_PER_RENDER = 100
+STEPS_PER_RENDER = 10
+
+# maximum number of points in each object's trail
+TRAIL_LENGTH = 100
+
+# a new trail point closer than this to the previous one replaces the last point instead.
+# Stored squared (in km^2) so comparing against it does not need a square root
+TRAIL_MIN_DIST_SQ = (WORLD_WIDTH * 0.01)**2
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def calculate_accelerations(pos, mass, gmm, acc):
+    '''Set acc (N x 2 array) to the acceleration of each object due to the gravitational forces between
+    all objects. pos is an N x 2 array, mass is an N array, and gmm is the N x N table of G * m1 * m2.'''
+    num_objects = len(mass)
+
+    # each object's force is accumulated from all other objects independently, so objects can be
+    # processed in parallel. Every pair is calculated twice, but no two threads write to the same object.
+    for i in prange(num_objects):
+        fx = 0.0
+        fy = 0.0
+        for j in range(num_objects):
+            if j == i:
+                continue
+
+            # dx, dy between 2 objects
+            dx = pos[j, 0] - pos[i, 0]
+            dy = pos[j, 1] - pos[i, 1]
+
+            # F = G * m1 * m2 / r^2 along the unit vector (dx, dy) / r, so
+            # the force components are G * m1 * m2 * (dx, dy) / r^3. No angles needed.
+            inv_r3 = (dx*dx + dy*dy)**-1.5
+            coeff = gmm[i, j] * inv_r3
+            fx += coeff * dx
+            fy += coeff * dy
 
-
-def pos_to_screen(pos):
-    'Given a position (2D vector in world coordinates), return screen coordinates in pixels'
-    w,h = Window.width, Window.height
-    ratio = w / WORLD_WIDTH
-    return (pos - np.array(WORLD_CENTER)) * ratio + np.array((w,h)) / 2
-
-def scalar_to_screen(s):
-    'Given a scalar in world coordinates (like size), return it in units of pixels'
-    ratio = Window.width / WORLD_WIDTH
-    return s * ratio
-
-def calculate_forces(objects):
-    '''For a given list of objects, calculate all accumulated forces on each object, and set the force. 
-    Each object must have self.pos, self.mass, and set_force() '''
-
-    # forces will be accumulated per object
-    forces = { obj:np.zeros((2)) for obj in objects }
-
-    # iterate through all pairs of objects, such that each pair is addressed once
-    num_objects = len(objects)
-    for i1 in range(num_objects-1):
-        for i2 in range(i1+1, num_objects):
-            obj1 = objects[i1]
-            obj2 = objects[i2]
-
-            # dx, dy and distance between 2 objects
-            delta = obj2.pos - obj1.pos
-            dist = np.linalg.norm(delta)
-
-            # force calculation
-            f_mag = GRAVITY_CONST * obj1.mass * obj2.mass / dist**2
-
-            # find force components in x and y
-            theta = atan2(delta[1], delta[0]) # angle between the two objects
-            fx = f_mag * cos(theta)
-            fy = f_mag * sin(theta)
-            f = np.array((fx, fy))
-            
-            # accumulate forces for each object
-            forces[obj1] += f
-            forces[obj2] += -f
-
-    # set accumulated force on each object
-    for obj in forces:
-        obj.set_force(forces[obj])
+        # F = m * a
+        acc[i, 0] = fx / mass[i]
+        acc[i, 1] = fy / mass[i]
+
+@njit(cache=True, fastmath=True)
+def step_many(pos, vel, mass, gmm, acc, dt, steps):
+    '''Advance the state of all objects by the given number of simulation steps of dt seconds.
+    pos and vel (N x 2 arrays) are updated in place. mass is an N array, gmm the N x N table of G * m1 * m2.
+    acc (N x 2 array) must hold the accelerations at the current positions, and is kept up to date.'''
+    num_objects = len(mass)
+
+    # 2nd order velocity Verlet integration. acc is carried over from the previous step,
+    # so forces are only calculated once per step.
+    for s in range(steps):
+        for i in range(num_objects):
+            pos[i, 0] += vel[i, 0] * dt + 0.5 * acc[i, 0] * dt * dt
+            pos[i, 1] += vel[i, 1] * dt + 0.5 * acc[i, 1] * dt * dt
+            vel[i, 0] += 0.5 * acc[i, 0] * dt
+            vel[i, 1] += 0.5 * acc[i, 1] * dt
+
+        calculate_accelerations(pos, mass, gmm, acc)
+
+        # the second half of vel += 0.5 * (acc_old + acc_new) * dt
+        for i in range(num_objects):
+            vel[i, 0] += 0.5 * acc[i, 0] * dt
+            vel[i, 1] += 0.5 * acc[i, 1] * dt
+
+# If Cython is installed, use the compiled versions from physics.pyx instead
+try:
+    import pyximport
+    pyximport.install(language_level=3)
+    from physics import calculate_accelerations, step_many
+except ImportError:
+    pass
 
 
 class MainWidget(Widget):
@@ -107,6 +129,10 @@ class MainWidget(Widget):
         # schedule a polling function callback every graphics frame
         Clock.schedule_interval(self.on_update, 0)
 
+        # world to screen conversion depends on window size. Recompute it only when the window changes
+        self._recompute_view()
+        Window.bind(on_resize=self._recompute_view)
+
         # text display
         self.info = Label(pos=(200, 200), halign='left', valign='bottom', text_size = (400, 400))
         self.add_widget(self.info)
@@ -114,37 +140,72 @@ class MainWidget(Widget):
         # global simulation time, in seconds
         self.time = 0
 
-        # objects of the simulation
-        self.objects = []
-
+        # initial conditions of each object: position, velocity, mass, radius, and color (hue)
         # For enhanced visibility, scale object radii by some factor
-        # Sun
-        self.objects.append(Body(pos = (0, 0), vel = (0, 0), radius = RAD_SUN * 20, mass = MASS_SUN, hue = 0.2))
-        # Mercury
-        self.objects.append(Body(pos = (DIST_MERCURY, 0), vel = (0, SPEED_MERCURY), radius = RAD_MERCURY * 1000, mass = MASS_MERCURY, hue = 0.4))
-        # Venus
-        self.objects.append(Body(pos = (DIST_VENUS, 0), vel = (0, SPEED_VENUS), radius = RAD_VENUS * 1000, mass = MASS_VENUS, hue = 0.8))
-        # Earth
-        self.objects.append(Body(pos = (DIST_EARTH, 0), vel = (0, SPEED_EARTH), radius = RAD_EARTH * 1000, mass = MASS_EARTH, hue = 0.6))
+        initial = [
+            # Sun
+            dict(pos = (0, 0), vel = (0, 0), radius = RAD_SUN * 20, mass = MASS_SUN, hue = 0.2),
+            # Mercury
+            dict(pos = (DIST_MERCURY, 0), vel = (0, SPEED_MERCURY), radius = RAD_MERCURY * 1000, mass = MASS_MERCURY, hue = 0.4),
+            # Venus
+            dict(pos = (DIST_VENUS, 0), vel = (0, SPEED_VENUS), radius = RAD_VENUS * 1000, mass = MASS_VENUS, hue = 0.8),
+            # Earth
+            dict(pos = (DIST_EARTH, 0), vel = (0, SPEED_EARTH), radius = RAD_EARTH * 1000, mass = MASS_EARTH, hue = 0.6),
+        ]
+
+        # state of all objects, stored as contiguous arrays (one row per object) so that
+        # the simulation can update all of them at once
+        self.pos = np.array([params['pos'] for params in initial], dtype=float)
+        self.vel = np.array([params['vel'] for params in initial], dtype=float)
+        self.mass = np.array([params['mass'] for params in initial], dtype=float)
+        self.radius = np.array([params['radius'] for params in initial], dtype=float)
+
+        # masses never change, so precompute G * m1 * m2 for every pair of objects
+        self.gmm = GRAVITY_CONST * self.mass[:, None] * self.mass[None, :]
+
+        # acceleration of each object at its current position, kept up to date by every simulation step
+        self.acc = np.empty_like(self.pos)
+        calculate_accelerations(self.pos, self.mass, self.gmm, self.acc)
+
+        # objects of the simulation. Each object refers to its row in the arrays above
+        self.objects = [Body(self, i, params['hue']) for i, params in enumerate(initial)]
 
         # add objects to canvas so they are displayed
         for obj in self.objects:
             self.canvas.add(obj)
 
+    def _recompute_view(self, *args):
+        'Update the cached conversion from world coordinates to screen coordinates for the current window size'
+        w,h = Window.width, Window.height
+        self._ratio = w / WORLD_WIDTH
+        self._ox = w / 2 - WORLD_CENTER[0] * self._ratio
+        self._oy = h / 2 - WORLD_CENTER[1] * self._ratio
+        self._offset = np.array((self._ox, self._oy), dtype=np.float32)
+
+    def world_to_screen_xy(self, x, y):
+        'Given a position (x, y) in world coordinates, return screen coordinates in pixels'
+        return (x * self._ratio + self._ox, y * self._ratio + self._oy)
+
+    def world_to_screen(self, pts, out=None):
+        '''Given an array of positions (K x 2) in world coordinates, return screen coordinates in pixels.
+        If out is given, the result is written into it (out may be pts itself)'''
+        out = np.multiply(pts, self._ratio, out=out)
+        out += self._offset
+        return out
+
+    def scalar_to_screen(self, s):
+        'Given a scalar in world coordinates (like size), return it in units of pixels'
+        return s * self._ratio
+
     # called every graphics frame
     def on_update(self, dt):
         # dt is normally the time in seconds between graphics frames.
         # instead, use a constant to advance time much faster.
         dt = DELTA_T
 
-        # run simulation for many time steps, and then render once after that
-        for s in range(STEPS_PER_RENDER):
-            self.time += dt
-
-            calculate_forces(self.objects)
-
-            for obj in self.objects:
-                obj.update_state(dt)
+        # run simulation for many time steps in a single compiled call, and then render once after that
+        step_many(self.pos, self.vel, self.mass, self.gmm, self.acc, dt, STEPS_PER_RENDER)
+        self.time += dt * STEPS_PER_RENDER
 
         # update graphics
         for obj in self.objects:
@@ -155,21 +216,15 @@ class MainWidget(Widget):
 
 
 class Body(InstructionGroup):
-    'A celestial body with initial position and velocity, mass, radius, and color (hue)'
-    def __init__(self, pos, vel, mass, radius, hue):
+    'A celestial body, drawn with a color (hue). Its state is stored in row idx of the widget\'s arrays'
+    def __init__(self, widget, idx, hue):
         super(Body, self).__init__()
 
-        # state variables
-        self.pos = np.array(pos)
-        self.vel = np.array(vel)
-        self.mass = mass
-        self.radius = radius
-
-        # force is a 2D vector, set by external calculation
-        self.force = np.zeros((2))
+        self.widget = widget
+        self.idx = idx
 
         # create trail (draw first so it is behind the circle)
-        self.trail = Trail()
+        self.trail = Trail(widget)
         self.add(self.trail)
 
         # create a color and a circle to represent this object
@@ -177,68 +232,95 @@ class Body(InstructionGroup):
         self.add( Color(hsv = (hue, .8, 1)))
         self.add( self.circle )
 
-    def set_force(self, f):
-        # apply externally calculated force to this object
-        self.force = f
+    # state variables, as views into the widget's arrays
+    @property
+    def pos(self):
+        return self.widget.pos[self.idx]
 
-    def update_state(self, dt):
-        # F = m * a
-        a = self.force / self.mass
+    @property
+    def vel(self):
+        return self.widget.vel[self.idx]
+
+    @property
+    def mass(self):
+        return self.widget.mass[self.idx]
 
-        # 1st order Euler integration step (this could be improved!!)
-        self.pos = self.pos + self.vel * dt
-        self.vel = self.vel + a * dt
+    @property
+    def radius(self):
+        return self.widget.radius[self.idx]
 
     def update_graphics(self):
         # convert from world parameters to screen coordinates:
-        sr = scalar_to_screen(self.radius)
+        pos = self.widget.pos[self.idx]
+        radius = self.widget.radius[self.idx]
+        sr = self.widget.scalar_to_screen(radius)
         self.circle.size = (sr*2, sr*2)
-        self.circle.pos =  pos_to_screen(self.pos - self.radius) # registration point of ellipse is bottom-left corner. We want circles centered
+        self.circle.pos =  self.widget.world_to_screen_xy(pos[0] - radius, pos[1] - radius) # registration point of ellipse is bottom-left corner. We want circles centered
 
         # update trail
-        self.trail.set_pos(self.pos)
+        self.trail.set_pos(pos)
         self.trail.update_graphics()
 
 
 class Trail(InstructionGroup):
     'Draws a trail to highlight recent motion of object'
-    def __init__(self):
+    def __init__(self, widget):
         super(Trail, self).__init__()
 
-        # list of points that make up the trail
-        self.points = []
+        # widget that converts world coordinates to screen coordinates
+        self.widget = widget
+
+        # points that make up the trail, stored in a ring buffer: _n points, the oldest at _head.
+        # These only end up as line points on screen, so float32 precision is plenty.
+        self._pts = np.empty((TRAIL_LENGTH, 2), dtype=np.float32)
+        self._n = 0
+        self._head = 0
 
         # A white line. Points of line are calculated in update_graphics()
         self.add(Color(1,1,1))
         self.line = Line(width=2)
         self.add(self.line)
 
+    def _index(self, i):
+        'index into the ring buffer of the i-th most recent point (i = -1 is the newest)'
+        return (self._head + self._n + i) % TRAIL_LENGTH
+
+    def _append(self, pos):
+        'add a point, removing the oldest point if the trail is full'
+        if self._n < TRAIL_LENGTH:
+            self._pts[self._index(0)] = pos
+            self._n += 1
+        else:
+            self._pts[self._head] = pos
+            self._head = (self._head + 1) % TRAIL_LENGTH
+
     def set_pos(self, pos):
         'set a new position in units of world coordinates'
 
         # must have at least two points to make a line
-        if len(self.points) < 2:
-            self.points.append(pos)
-
-        # if new pos is very close to last pos, don't add the point. Just update the last pos to current.
-        elif np.linalg.norm(self.points[-2] - pos) < (WORLD_WIDTH * 0.01):
-            self.points[-1] = pos
-        
-        # if new pos is far away from previous pos, add it.
+        if self._n < 2:
+            self._append(pos)
+
         else:
-            self.points.append(pos)
+            prev = self._pts[self._index(-2)]
+            dx = prev[0] - pos[0]
+            dy = prev[1] - pos[1]
+
+            # if new pos is very close to last pos, don't add the point. Just update the last pos to current.
+            if dx*dx + dy*dy < TRAIL_MIN_DIST_SQ:
+                self._pts[self._index(-1)] = pos
 
-        # remove old points.
-        if len(self.points) > 100:
-            self.points = self.points[1:]
+            # if new pos is far away from previous pos, add it.
+            else:
+                self._append(pos)
 
     def update_graphics(self):
-        # convert points to screen coordinates and set the line's points
-        screen_points = []
-        for p in self.points:
-            screen_points = screen_points + pos_to_screen(p).tolist()
-        self.line.points = screen_points
-            
+        # put points in order from oldest to newest (np.roll makes a copy), convert that copy
+        # to screen coordinates in place, and set the line's points
+        points = np.roll(self._pts[:self._n], -self._head, axis=0)
+        self.widget.world_to_screen(points, out=points)
+        self.line.points = points.ravel().tolist()
+
 
 # Build and run the app
 class MainApp(App):
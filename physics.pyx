@@ -0,0 +1,79 @@
+#####################################################################
+#
+# Copyright (c) 2023 Eran Egozy
+# License: MIT
+#
+#####################################################################
+
+# Cython version of the simulation loop in app.py. It is compiled automatically
+# (with pyximport) when app.py starts, if Cython is installed.
+
+cimport cython
+from libc.math cimport sqrt
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef void calculate_accelerations(double[:, ::1] pos, double[::1] mass, double[:, ::1] gmm,
+                                  double[:, ::1] acc):
+    '''Set acc (N x 2 array) to the acceleration of each object due to the gravitational forces between
+    all objects. pos is an N x 2 array, mass is an N array, and gmm is the N x N table of G * m1 * m2.'''
+    cdef Py_ssize_t num_objects = mass.shape[0]
+    cdef Py_ssize_t i, j
+    cdef double dx, dy, r2, coeff, fx_ij, fy_ij
+
+    # forces will be accumulated per object
+    acc[:, :] = 0
+
+    # iterate through all pairs of objects, such that each pair is addressed once
+    for i in range(num_objects-1):
+        for j in range(i+1, num_objects):
+            # dx, dy between 2 objects
+            dx = pos[j, 0] - pos[i, 0]
+            dy = pos[j, 1] - pos[i, 1]
+
+            # force components are G * m1 * m2 * (dx, dy) / r^3
+            r2 = dx*dx + dy*dy
+            coeff = gmm[i, j] / (r2 * sqrt(r2))
+            fx_ij = coeff * dx
+            fy_ij = coeff * dy
+
+            # accumulate forces for each object
+            acc[i, 0] += fx_ij
+            acc[i, 1] += fy_ij
+            acc[j, 0] -= fx_ij
+            acc[j, 1] -= fy_ij
+
+    # F = m * a
+    for i in range(num_objects):
+        acc[i, 0] /= mass[i]
+        acc[i, 1] /= mass[i]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def step_many(double[:, ::1] pos, double[:, ::1] vel, double[::1] mass, double[:, ::1] gmm,
+              double[:, ::1] acc, double dt, int steps):
+    '''Advance the state of all objects by the given number of simulation steps of dt seconds.
+    pos and vel (N x 2 arrays) are updated in place. mass is an N array, gmm the N x N table of G * m1 * m2.
+    acc (N x 2 array) must hold the accelerations at the current positions, and is kept up to date.'''
+    cdef Py_ssize_t num_objects = mass.shape[0]
+    cdef Py_ssize_t i
+    cdef int s
+
+    # 2nd order velocity Verlet integration. acc is carried over from the previous step,
+    # so forces are only calculated once per step.
+    for s in range(steps):
+        for i in range(num_objects):
+            pos[i, 0] += vel[i, 0] * dt + 0.5 * acc[i, 0] * dt * dt
+            pos[i, 1] += vel[i, 1] * dt + 0.5 * acc[i, 1] * dt * dt
+            vel[i, 0] += 0.5 * acc[i, 0] * dt
+            vel[i, 1] += 0.5 * acc[i, 1] * dt
+
+        calculate_accelerations(pos, mass, gmm, acc)
+
+        # the second half of vel += 0.5 * (acc_old + acc_new) * dt
+        for i in range(num_objects):
+            vel[i, 0] += 0.5 * acc[i, 0] * dt
+            vel[i, 1] += 0.5 * acc[i, 1] * dt